@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+from bson import ObjectId
+
+import heavy_main
+
+
+class CountingCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length=None):
+        return list(self.docs)
+
+
+class CountingCollection:
+    """Just enough of an async collection for list_products, counting every command"""
+
+    def __init__(self, docs, commands):
+        self.docs = docs
+        self.commands = commands
+
+    def find(self, query=None, projection=None):
+        self.commands.append("find")
+        ids = (query or {}).get("_id", {}).get("$in")
+        docs = self.docs if ids is None else [d for d in self.docs if d["_id"] in ids]
+        return CountingCursor(docs)
+
+
+def seed(monkeypatch, n_products):
+    commands = []
+    categories = [{"_id": ObjectId(), "name": f"category {i}"} for i in range(5)]
+    themes = [{"_id": ObjectId(), "name": f"theme {i}"} for i in range(3)]
+    products = [
+        {
+            "_id": ObjectId(),
+            "name": f"product {i}",
+            "category_id": categories[i % len(categories)]["_id"],
+            "theme_id": themes[i % len(themes)]["_id"],
+            "selling_price": 10,
+            "mrp": 20,
+            "availability": "In Stock",
+            "description": "",
+            "display_image": None,
+            "hover_image": None,
+        }
+        for i in range(n_products)
+    ]
+    monkeypatch.setattr(heavy_main, "product_collection", CountingCollection(products, commands), raising=False)
+    monkeypatch.setattr(heavy_main, "category_collection", CountingCollection(categories, commands), raising=False)
+    monkeypatch.setattr(heavy_main, "theme_collection", CountingCollection(themes, commands), raising=False)
+    return commands
+
+
+@pytest.mark.parametrize("n_products", [5, 55])
+def test_list_products_resolves_names(monkeypatch, n_products):
+    seed(monkeypatch, n_products)
+    result = asyncio.run(heavy_main.list_products(token={"sub": "admin"}))
+
+    assert result["total_products"] == n_products
+    assert all(p["category_name"].startswith("category ") for p in result["products"])
+    assert all(p["theme_name"].startswith("theme ") for p in result["products"])
+
+
+def test_list_products_command_count_is_constant(monkeypatch):
+    counts = []
+    for n_products in (5, 55):
+        commands = seed(monkeypatch, n_products)
+        asyncio.run(heavy_main.list_products(token={"sub": "admin"}))
+        counts.append(len(commands))
+
+    assert counts[0] == counts[1] == 3
@@ -0,0 +1,247 @@
+import asyncio
+import io
+from types import SimpleNamespace
+
+import pytest
+from bson import ObjectId
+from fastapi import HTTPException
+from pymongo.errors import DuplicateKeyError
+from starlette.datastructures import Headers, UploadFile
+
+import heavy_main
+
+
+def matches(doc, query):
+    for key, cond in query.items():
+        value = doc.get(key)
+        if not isinstance(cond, dict):
+            if value != cond:
+                return False
+            continue
+        for op, arg in cond.items():
+            if op == "$ne" and value == arg:
+                return False
+            if op == "$lt" and not (value is not None and value < arg):
+                return False
+            if op == "$lte" and not (value is not None and value <= arg):
+                return False
+            if op == "$in" and value not in arg:
+                return False
+            if op == "$exists" and (key in doc) != arg:
+                return False
+    return True
+
+
+def apply_update(doc, update, inserting=False):
+    for key, value in update.get("$inc", {}).items():
+        doc[key] = doc.get(key, 0) + value
+    doc.update(update.get("$set", {}))
+    if inserting:
+        doc.update(update.get("$setOnInsert", {}))
+    for key in update.get("$unset", {}):
+        doc.pop(key, None)
+
+
+class FakeCollection:
+    """Just enough of an async collection for the upload ref protocol.
+
+    Every call yields to the loop first, so concurrent callers interleave
+    between commands the way they would against a real server.
+    """
+
+    def __init__(self, docs=()):
+        self.docs = {d["_id"]: dict(d) for d in docs}
+
+    def _find(self, query):
+        return next((d for d in self.docs.values() if matches(d, query)), None)
+
+    async def find_one(self, query, projection=None):
+        await asyncio.sleep(0)
+        doc = self._find(query)
+        return dict(doc) if doc else None
+
+    async def update_one(self, query, update, upsert=False):
+        await asyncio.sleep(0)
+        doc = self._find(query)
+        if doc is not None:
+            apply_update(doc, update)
+            return SimpleNamespace(matched_count=1, modified_count=1, upserted_id=None)
+        if not upsert:
+            return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=None)
+        if query["_id"] in self.docs:
+            raise DuplicateKeyError("duplicate _id")
+        doc = {"_id": query["_id"]}
+        apply_update(doc, update, inserting=True)
+        self.docs[doc["_id"]] = doc
+        return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=doc["_id"])
+
+    async def find_one_and_update(self, query, update, return_document=None):
+        await asyncio.sleep(0)
+        doc = self._find(query)
+        if doc is None:
+            return None
+        apply_update(doc, update)
+        return dict(doc)
+
+    async def find_one_and_delete(self, query, projection=None):
+        await asyncio.sleep(0)
+        doc = self._find(query)
+        if doc is None:
+            return None
+        return self.docs.pop(doc["_id"])
+
+    async def delete_one(self, query):
+        await asyncio.sleep(0)
+        doc = self._find(query)
+        if doc is not None:
+            del self.docs[doc["_id"]]
+        return SimpleNamespace(deleted_count=int(doc is not None))
+
+
+class PausingStorage(heavy_main.LocalUploadStorage):
+    """Local storage whose unlinks wait until the test lets them through"""
+
+    def __init__(self):
+        self.unlinking = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def remove_file_set(self, url):
+        self.unlinking.set()
+        await self.release.wait()
+        return await super().remove_file_set(url)
+
+
+@pytest.fixture
+def uploads(monkeypatch, tmp_path):
+    """Upload volume in tmp_path, fake ref/ledger collections and a stub transcode"""
+    state = SimpleNamespace(refs=FakeCollection(), ledger=[], transcodes=0, fail_transcode=None)
+
+    async def fake_image_job(fn, raw_path, dest):
+        state.transcodes += 1
+        if state.fail_transcode is not None:
+            fail, state.fail_transcode = state.fail_transcode, None
+            await fail()
+        with open(raw_path, "rb") as src:
+            data = src.read()
+        heavy_main.Path(dest).parent.mkdir(parents=True, exist_ok=True)
+        heavy_main.Path(dest).write_bytes(data)
+        return len(data)
+
+    async def fake_add_upload_bytes(delta):
+        if delta:
+            state.ledger.append(delta)
+
+    monkeypatch.setattr(heavy_main, "UPLOAD_VOLUMES", {heavy_main.DEFAULT_UPLOAD_VOLUME: tmp_path})
+    monkeypatch.setattr(heavy_main, "pick_upload_volume", lambda needed=0: heavy_main.DEFAULT_UPLOAD_VOLUME)
+    monkeypatch.setattr(heavy_main, "upload_storage", heavy_main.LocalUploadStorage())
+    monkeypatch.setattr(heavy_main, "upload_ref_collection", state.refs, raising=False)
+    monkeypatch.setattr(heavy_main, "run_image_job", fake_image_job)
+    monkeypatch.setattr(heavy_main, "add_upload_bytes", fake_add_upload_bytes)
+    monkeypatch.setattr(heavy_main, "UPLOAD_REF_POLL", 0.001)
+    return state
+
+
+def upload_file(data: bytes) -> UploadFile:
+    return UploadFile(file=io.BytesIO(data), headers=Headers({"content-type": "image/jpeg"}))
+
+
+def store(data: bytes):
+    return heavy_main.store_upload(upload_file(data), heavy_main.THEME_UPLOAD_DIR)
+
+
+def test_concurrent_uploads_of_same_bytes_store_once(uploads):
+    async def run():
+        return await asyncio.gather(store(b"same bytes"), store(b"same bytes"))
+
+    first, second = asyncio.run(run())
+
+    assert first == second
+    ref = uploads.refs.docs[first]
+    assert ref["refs"] == 2 and ref["ready"] is True and "storing_by" not in ref
+    assert uploads.transcodes == 1
+    assert uploads.ledger == [len(b"same bytes")]
+    assert heavy_main.upload_url_path(first).exists()
+
+
+def test_failed_store_is_taken_over_by_a_waiter(uploads):
+    async def run():
+        async def fail_once_waiter_arrives():
+            # hold the first store until the second caller has taken its ref
+            while not any(r.get("refs") == 2 for r in uploads.refs.docs.values()):
+                await asyncio.sleep(0.001)
+            raise OSError("cannot identify image file")
+
+        uploads.fail_transcode = fail_once_waiter_arrives
+        return await asyncio.gather(store(b"shared"), store(b"shared"), return_exceptions=True)
+
+    results = asyncio.run(run())
+
+    failed = [r for r in results if isinstance(r, HTTPException)]
+    stored = [r for r in results if isinstance(r, str)]
+    assert len(failed) == 1 and failed[0].status_code == 400
+    assert len(stored) == 1
+    ref = uploads.refs.docs[stored[0]]
+    assert ref["refs"] == 1 and ref["ready"] is True
+    assert uploads.transcodes == 2
+    assert uploads.ledger == [len(b"shared")]
+    assert heavy_main.upload_url_path(stored[0]).exists()
+
+
+def test_remove_racing_store_stores_afresh(uploads, monkeypatch):
+    url = asyncio.run(store(b"racy"))
+    storage = PausingStorage()
+    monkeypatch.setattr(heavy_main, "upload_storage", storage)
+
+    async def run():
+        removal = asyncio.create_task(heavy_main.remove_upload(url))
+        await storage.unlinking.wait()
+        storing = asyncio.create_task(store(b"racy"))
+        await asyncio.sleep(0.02)
+        # the store hit the tombstone and must not re-reference files being unlinked
+        assert not storing.done()
+        storage.release.set()
+        await removal
+        return await storing
+
+    assert asyncio.run(run()) == url
+    ref = uploads.refs.docs[url]
+    assert ref["refs"] == 1 and ref["ready"] is True and "deleting" not in ref
+    assert uploads.transcodes == 2
+    assert uploads.ledger == [len(b"racy"), -len(b"racy"), len(b"racy")]
+    assert heavy_main.upload_url_path(url).exists()
+
+
+def test_concurrent_deletes_of_a_product_drop_its_refs_once(uploads, monkeypatch):
+    url = asyncio.run(store(b"shared image"))
+    asyncio.run(store(b"shared image"))
+    product_id = ObjectId()
+    products = FakeCollection([
+        {"_id": product_id, "display_image": url},
+        {"_id": ObjectId(), "display_image": url},
+    ])
+    queued = []
+
+    async def noop(**kwargs):
+        pass
+
+    monkeypatch.setattr(heavy_main, "product_collection", products, raising=False)
+    monkeypatch.setattr(heavy_main, "enqueue_upload_removal", lambda *urls: queued.extend(u for u in urls if u))
+    monkeypatch.setattr(heavy_main, "bump_catalog_stats", noop)
+    monkeypatch.setattr(heavy_main, "schedule_homepage_rebuild", lambda: None)
+
+    async def run():
+        results = await asyncio.gather(
+            heavy_main.delete_product(str(product_id), token={"sub": "admin"}),
+            heavy_main.delete_product(str(product_id), token={"sub": "admin"}),
+            return_exceptions=True,
+        )
+        for queued_url in queued:
+            await heavy_main.remove_upload(queued_url)
+        return results
+
+    results = asyncio.run(run())
+
+    assert sum(isinstance(r, HTTPException) and r.status_code == 404 for r in results) == 1
+    assert queued == [url]
+    assert uploads.refs.docs[url]["refs"] == 1
+    assert heavy_main.upload_url_path(url).exists()